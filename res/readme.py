@@ -1,11 +1,39 @@
 #!/usr/bin/python3
 
-import os, subprocess 
+import os, sys, shlex, hashlib, subprocess 
+
+CACHE_DIR = '.cache'
+
+outputs = {}
+
+def capture(command):
+    script, *argv = shlex.split(command)
+    argv = (sys.executable, os.path.join('soapyfile', script), *argv)
+    if argv not in outputs:
+        # output only changes when the script, the arguments or the
+        # interpreter do, argparse formatting varies between versions
+        with open(argv[1], 'rb') as f:
+            key = '\0'.join((sys.version, *argv)).encode()
+            key = hashlib.sha1(f.read() + key).hexdigest()
+        filename = os.path.join(CACHE_DIR, f'output-{key}.txt')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                outputs[argv] = f.read()
+        else:
+            result = subprocess.run(
+                argv,
+                # pin the width argparse wraps help text to
+                env={**os.environ, 'PYTHONPATH': '.', 'COLUMNS': '80'},
+                stdout=subprocess.PIPE,
+                check=True)
+            outputs[argv] = result.stdout.decode()
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(filename, 'w') as f:
+                f.write(outputs[argv])
+    return outputs[argv]
 
 def run(command, language=''):
-    proc = subprocess.Popen("PYTHONPATH=. python3 soapyfile/" + command, shell=True, stdout=subprocess.PIPE)
-    buf = proc.stdout.read().decode()
-    proc.wait()
+    buf = capture(command)
     text = f"""
 ```{language}
 $ {command}
@@ -96,8 +124,11 @@ The /pcm endpoint streams 16 bit integer WAV.  The /float endpoint streams 32-bi
 float WAV.  While the /cf32 endpoint streams in raw cf32 format.  Run soapyfile with the --pause option if
 you only want to stream over HTTP.  (No SDR program that I know of currently supports HTTP streams,
 however it might be useful for remote operation or sharing a stream in real time.)
+A finished recording, one closed by pausing, can be fetched from /download.
 
 Peak sample data (dBFS) and frequency power data (rtl_power output format) is streamed out of URL paths /peak and /power as text.
+The peak, shown by --meter and streamed by /peak, is the magnitude of the complex IQ sample,
+so a full scale signal on both I and Q reads up to +3 dBFS.
 
 ```
 GET /pcm               return a 16-bit integer PCM WAV HTTP audio stream
@@ -106,6 +137,7 @@ GET /cf32              return a 32-bit IEEE floating point raw "cf32" HTTP audio
 GET /peak              return latest ADC peak values (dBFS) as a HTTP stream
 GET /power             return power values (dB) of the FTT as a HTTP stream in rtl_power output format
 GET /waterfall         return an ascii waterfall of the FTT as a HTTP stream
+GET /download          return the most recently closed recording file
 ```
 
 Here are some sample curl commands:
@@ -206,6 +238,9 @@ The FFT / power / waterfall feature uses a lot of compute power.
 If you are getting streaming errors, especially on the
 Raspberry Pi or Orange Pi, pass the --nopower option
 to turn off FFT computation. 
+The FFT is only computed while the --waterfall option is given or a
+/power or /waterfall client is connected, and likewise the peak meter
+only runs while it is being displayed or streamed.
 
 ## Benchmarks
 
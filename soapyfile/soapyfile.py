@@ -3,12 +3,15 @@
 import os
 import sys
 import time
+import math
 import datetime
 import argparse
 import numpy as np
-from struct import pack, calcsize
-from queue import Queue
-from threading import Thread, Lock
+from struct import Struct
+from functools import lru_cache
+from queue import Queue, Empty
+from collections import deque
+from threading import Thread, Lock, Condition, Event
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 
@@ -44,6 +47,7 @@ def parse_args():
     group = parser.add_argument_group('streaming options')
     group.add_argument('--packet-size', default=1024, type=int, help='soapysdr packet size in bytes')
     group.add_argument('--buffer-size', default=256, type=int, help='stream buffer size in MB')
+    group.add_argument('--stream-buffers', type=int, help='number of soapysdr driver buffers')
 
     # power measurment options
     group = parser.add_argument_group('power measurement options')
@@ -75,12 +79,12 @@ def afloat(text):
         pass
 
 
+BOOLEAN_TEXT = {
+    'y': True, 'yes': True, 'true': True, '1': True,
+    'n': False, 'no': False, 'false': False, '0': False}
+
 def abool(text):
-    text = text.strip().lower()
-    if text == 'y' or text == 'yes' or text == 'true' or text == '1':
-        return True
-    if text == 'n' or text == 'no' or text == 'false' or text == '0':
-        return False
+    return BOOLEAN_TEXT.get(text.strip().lower())
 
 
 def tobool(val):
@@ -99,20 +103,22 @@ def timestamp():
     return now.strftime('%y%m%d%H%M%S')
 
 
+LOG_TEXT = (
+    None,
+    "FATAL",
+    "CRITICAL",
+    "ERROR",
+    "WARNING",
+    "NOTICE",
+    "INFO",
+    "DEBUG",
+    "TRACE",
+    "SSI")
+
 def log_handler(log_level, message):
-    log_text = {
-        1: "FATAL",
-        2: "CRITICAL",
-        3: "ERROR",
-        4: "WARNING",
-        5: "NOTICE",
-        6: "INFO",
-        7: "DEBUG",
-        8: "TRACE",
-        9: "SSI"}
     now = datetime.datetime.now(datetime.UTC)
-    ts = now.strftime('%H:%M:%S')
-    println("[{}] {}: {}".format(ts, log_text[log_level], message))
+    # drivers log from the thread calling readStream, eg. overflows
+    console.println(f'[{now:%H:%M:%S}] {LOG_TEXT[log_level]}: {message}')
 
 
 ## soapysdr setters
@@ -180,8 +186,7 @@ def get_gain(radio):
 
 
 def get_radio_setting(radio, name):
-    settings = [ d.key for d in radio.getSettingInfo() ]
-    if name in settings:
+    if name in state.setting_keys:
         return radio.readSetting(name) 
 
 
@@ -194,50 +199,111 @@ def wav_systemtime():
     return (ts.year, ts.month, dow, ts.day, ts.hour, ts.minute, ts.second, msec)
 
 
-def wav_header(sample_bytes, frequency, rate, rf64=False, data_size=None, **kw):
+WAV_CHUNK = Struct('<4sI')
+WAV_FMT = Struct('<HHIIHH')
+WAV_SYSTEMTIME = Struct('<HHHHHHHH')
+WAV_AUXI = Struct('<IIIIIIIII')
+WAV_DS64 = Struct('<QQQ')
+
+
+def wav_set_size(buf, sample_bytes, rf64, data_size):
+    # patch the riff, ds64 and data sizes of a header in place
     MAX_UINT32 = 0xffffffff
     MAX_UINT64 = 0xffffffffffffffff
-    data_size = MAX_UINT64 if data_size is None else data_size
+    block_align = 2 * sample_bytes
+    chunk_size = WAV_CHUNK.size
+    riff_size = data_size + len(buf) - chunk_size
+    data_offset = len(buf) - chunk_size
+    if rf64:
+        sample_count = data_size // block_align
+        WAV_DS64.pack_into(buf, data_offset - WAV_DS64.size,
+                           min(riff_size, MAX_UINT64), data_size, sample_count)
+        WAV_CHUNK.pack_into(buf, data_offset, b'data', MAX_UINT32)
+        WAV_CHUNK.pack_into(buf, 0, b'RF64', MAX_UINT32)
+    else:
+        WAV_CHUNK.pack_into(buf, data_offset, b'data', min(data_size, MAX_UINT32))
+        WAV_CHUNK.pack_into(buf, 0, b'RIFF', min(riff_size, MAX_UINT32))
+
+
+@lru_cache(maxsize=16)
+def wav_template(sample_bytes, frequency, rate, rf64):
+    # everything but the start time, which is left zeroed at the
+    # returned offset.  streams with the same parameters share it.
+    # the size is unknown so it is set to the largest possible.
+    MAX_UINT64 = 0xffffffffffffffff
 
     # setup
     channels = 2
     block_align = channels * sample_bytes
+    chunk_size = WAV_CHUNK.size
+    auxi_size = 2 * WAV_SYSTEMTIME.size + WAV_AUXI.size
+    buf = bytearray(
+        chunk_size + 4 +
+        chunk_size + WAV_FMT.size +
+        chunk_size + auxi_size +
+        (chunk_size + WAV_DS64.size if rf64 else 0) +
+        chunk_size)
+    offset = chunk_size
+    buf[offset:offset+4] = b'WAVE'
+    offset += 4
 
     # fmt
     fmt_format = 3 if sample_bytes == 4 else 1
     byte_rate = rate * block_align
     bits_per_sample = 8 * sample_bytes
-    fmt_data = pack('<HHIIHH', fmt_format, channels, 
-               rate, byte_rate, block_align, bits_per_sample)
+    WAV_CHUNK.pack_into(buf, offset, b'fmt ', WAV_FMT.size)
+    WAV_FMT.pack_into(buf, offset + chunk_size, fmt_format, channels, 
+                      rate, byte_rate, block_align, bits_per_sample)
+    offset += chunk_size + WAV_FMT.size
 
     # auxi
-    start_time = pack('<HHHHHHHH', *wav_systemtime())
-    auxi_data = pack('<16s16sIIIIIIIII', start_time, start_time,
-                frequency, rate, 0, rate, 0, 0, 0, 0, 0)
+    WAV_CHUNK.pack_into(buf, offset, b'auxi', auxi_size)
+    offset += chunk_size
+    time_offset = offset
+    WAV_AUXI.pack_into(buf, offset + 2 * WAV_SYSTEMTIME.size,
+                       frequency, rate, 0, rate, 0, 0, 0, 0, 0)
+    offset += auxi_size
+
+    # ds64
+    if rf64:
+        WAV_CHUNK.pack_into(buf, offset, b'ds64', WAV_DS64.size)
 
-    # riff
-    riff_data = b'WAVE'
-    riff_data += pack('<4sI', b'fmt ', len(fmt_data)) + fmt_data
-    riff_data += pack('<4sI', b'auxi', len(auxi_data)) + auxi_data
+    wav_set_size(buf, sample_bytes, rf64, MAX_UINT64)
+    return bytes(buf), time_offset
 
-    if rf64:
-        # ds64
-        ds64_format = '<QQQ'
-        sample_count = data_size // block_align
-        riff_size = data_size + len(riff_data) + 16 + calcsize(ds64_format)
-        ds64_data = pack(ds64_format, min(riff_size, MAX_UINT64), data_size, sample_count)
-
-        # riff continued
-        riff_data += pack('<4sI', b'ds64', len(ds64_data)) + ds64_data
-        riff_data += pack('<4sI', b'data', MAX_UINT32)
-        riff_size = MAX_UINT32
-        buf = pack('<4sI', b'RF64', riff_size) + riff_data
-    else:
-        riff_data += pack('<4sI', b'data', min(data_size, MAX_UINT32))
-        riff_size = data_size + len(riff_data)
-        buf = pack('<4sI', b'RIFF', min(riff_size, MAX_UINT32)) + riff_data
 
-    return buf
+def wav_header(sample_bytes, frequency, rate, rf64=False, data_size=None, **kw):
+    template, offset = wav_template(sample_bytes, frequency, rate, rf64)
+    buf = bytearray(template)
+    if data_size is not None:
+        wav_set_size(buf, sample_bytes, rf64, data_size)
+    start_time = wav_systemtime()
+    WAV_SYSTEMTIME.pack_into(buf, offset, *start_time)
+    WAV_SYSTEMTIME.pack_into(buf, offset + WAV_SYSTEMTIME.size, *start_time)
+    return bytes(buf)
+
+
+PCM_MAX = np.float32(0x7fff)
+PCM_MIN = np.float32(-0x8000)
+
+class PCMConverter:
+    # float samples to 16-bit PCM, reusing its buffers for every packet
+    def __init__(self):
+        self.scaled = None
+        self.pcm = None
+
+    def convert(self, d):
+        if self.pcm is None or self.pcm.shape != d.shape:
+            self.scaled = np.empty(d.shape, dtype=np.float32)
+            self.pcm = np.empty(d.shape, dtype=np.int16)
+        np.multiply(d, PCM_MAX, out=self.scaled)
+        # rounding and clamping in float32 and then assigning is cheaper
+        # than np.clip and an unsafe-cast rint into the int16 buffer
+        np.rint(self.scaled, out=self.scaled)
+        np.minimum(self.scaled, PCM_MAX, out=self.scaled)
+        np.maximum(self.scaled, PCM_MIN, out=self.scaled)
+        self.pcm[...] = self.scaled
+        return self.pcm
 
 
 #########################
@@ -245,29 +311,176 @@ def wav_header(sample_bytes, frequency, rate, rf64=False, data_size=None, **kw):
 #########################
 
 
-class QueueInventory:
+class BufferPool:
     def __init__(self):
         self.lock = Lock()
-        self.inventory = []
+        self.free = []
+        self.users = {}
+        self.size = 0
+        self.limit = 0
+
+    def initialize(self, size, count=0):
+        # the prefilled buffers are rows of one contiguous allocation.
+        # no more than count buffers are kept free, any extra ones are
+        # left to the garbage collector once a backlog drains
+        self.size = size
+        self.limit = count
+        self.free = list(np.empty((count, size), dtype=np.float32))
+
+    def acquire(self):
+        # reuse a released buffer, only allocate when none is free
+        with self.lock:
+            buf = self.free.pop() if self.free else None
+        if buf is None:
+            buf = np.empty(self.size, dtype=np.float32)
+        buf.flags.writeable = True
+        return buf
+
+    def share(self, buf, count, length=None):
+        # returns the packet to hand out, the first length values of the
+        # buffer.  the buffer is recycled once all count consumers
+        # release the packet
+        buf.flags.writeable = False
+        packet = buf if length is None or length == buf.size else buf[:length]
+        with self.lock:
+            if count:
+                self.users[id(packet)] = count, buf
+            elif len(self.free) < self.limit:
+                self.free.append(buf)
+        return packet
+
+    def release(self, packet):
+        with self.lock:
+            count, buf = self.users.pop(id(packet))
+            if count > 1:
+                self.users[id(packet)] = count - 1, buf
+            elif len(self.free) < self.limit:
+                self.free.append(buf)
+
+
+class StreamQueue:
+    # single producer and single consumer.  with the GIL a deque append
+    # or popleft is atomic, so the lock is only taken to sleep, or to
+    # wake the other side after it announced it is about to sleep.
+    # a buffer returned by get() stays valid until the next get().
+    # with drop set a full queue discards its oldest buffer instead of
+    # blocking the producer
+    def __init__(self, pool, maxsize=0, drop=False):
+        self.pool = pool
+        self.maxsize = maxsize
+        self.drop = drop
+        self.items = deque()
+        lock = Lock()
+        self.not_empty = Condition(lock)
+        self.not_full = Condition(lock)
+        self.getting = False
+        self.putting = False
+        self.closed = False
+        self.held = None
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def put(self, buf):
+        # the producer may still hold a queue that was just closed
+        if self.closed:
+            self.pool.release(buf)
+            return
+        if self.drop and self.full():
+            try:
+                self.pool.release(self.items.popleft())
+            except IndexError:
+                pass
+        elif self.full():
+            with self.not_full:
+                self.putting = True
+                while self.full():
+                    self.not_full.wait()
+                self.putting = False
+        self.items.append(buf)
+        if self.closed:
+            self.drain()
+        elif self.getting:
+            with self.not_empty:
+                self.not_empty.notify()
+
+    def get(self, block=True):
+        self.release()
+        while True:
+            # a dropping producer may take the item seen here, so
+            # retry rather than trust the check
+            try:
+                self.held = self.items.popleft()
+                break
+            except IndexError:
+                if not block:
+                    raise Empty
+            with self.not_empty:
+                self.getting = True
+                while not self.items:
+                    self.not_empty.wait()
+                self.getting = False
+        if self.putting:
+            with self.not_full:
+                self.not_full.notify()
+        return self.held
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def release(self):
+        if self.held is not None:
+            self.pool.release(self.held)
+            self.held = None
+
+    def drain(self):
+        try:
+            while True:
+                self.pool.release(self.items.popleft())
+        except IndexError:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.release()
+        self.drain()
+        with self.not_full:
+            self.not_full.notify()
+
+
+class QueueInventory:
+    def __init__(self, pool=None):
+        # the inventory is an immutable tuple that is replaced, never
+        # mutated, so readers can use it without taking the lock
+        self.lock = Lock()
+        self.inventory = ()
         self.maxsize = 0
+        self.pool = pool
 
     def initialize(self, maxsize):
         self.maxsize = maxsize 
 
-    def checkout_item(self):
+    def checkout_item(self, drop=False):
         # if maxsize is 0 or less then queue size is infinite
-        q = Queue(maxsize=self.maxsize)
+        if self.pool:
+            q = StreamQueue(self.pool, maxsize=self.maxsize, drop=drop)
+        else:
+            q = Queue(maxsize=self.maxsize)
         with self.lock:
-            self.inventory.append(q)
+            self.inventory += (q,)
         return q
     
     def return_item(self, q):
         with self.lock:
-            self.inventory.remove(q)
+            self.inventory = tuple(d for d in self.inventory if d is not q)
+        if self.pool:
+            q.close()
 
     def current(self):
-        with self.lock:
-            return list(self.inventory)
+        return self.inventory
+
+    def active(self):
+        return len(self.inventory) > 0
  
 
 class State:
@@ -281,6 +494,8 @@ class State:
         self.rate = rate
         self.frequency = frequency
         self.radio = radio
+        # the available settings of a device do not change
+        self.setting_keys = [ d.key for d in radio.getSettingInfo() ]
         self.notimestamp = notimestamp
         self.output = output
         self.hostname = hostname
@@ -294,15 +509,53 @@ class State:
         state.average = average
         state.waterfall = waterfall
         state.meter = meter
+        self.recording = None
         self.done = False
         self.quit = False
 
+
+class Console:
+    # meter, waterfall and driver log lines are printed by a background
+    # thread, so a slow terminal or pipe never holds up capture.  if it
+    # falls behind the oldest lines are dropped.  until capture starts
+    # the thread lines are printed directly.
+    def __init__(self):
+        self.lines = deque(maxlen=1024)
+        self.ready = Event()
+        self.started = False
+
+    def initialize(self):
+        t = Thread(target=self.drain, daemon=True)
+        t.start()
+        self.started = True
+
+    def println(self, buf):
+        if not self.started:
+            return println(buf)
+        self.lines.append(buf)
+        self.ready.set()
+
+    def drain(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            self.flush()
+
+    def flush(self):
+        try:
+            while True:
+                println(self.lines.popleft())
+        except IndexError:
+            pass
+
         
+stream_buffer_pool = BufferPool()
 peak_queue_inventory = QueueInventory()
 power_queue_inventory = QueueInventory()
-stream_queue_inventory = QueueInventory()
+stream_queue_inventory = QueueInventory(stream_buffer_pool)
 waterfall_queue_inventory = QueueInventory()
 state = State()
+console = Console()
 
 
 #########################
@@ -315,9 +568,16 @@ def server():
         protocol_version = 'HTTP/1.1'
 
         def send_chunk(self, buf):
-            self.wfile.write(b'%X\r\n' % len(buf))
-            self.wfile.write(buf)
-            self.wfile.write(b'\r\n')
+            # wfile is unbuffered, so gather the framing and the payload
+            # into one sendmsg rather than copying them together.
+            # sendmsg is only available on unix.
+            parts = (b'%X\r\n' % len(buf), buf, b'\r\n')
+            if not hasattr(self.request, 'sendmsg'):
+                self.wfile.write(b''.join(parts))
+                return
+            sent = self.request.sendmsg(parts)
+            if sent < len(parts[0]) + len(buf) + 2:
+                self.request.sendall(b''.join(parts)[sent:])
 
         def text_streaming(self, queue_inventory):
             q = queue_inventory.checkout_item()
@@ -333,7 +593,8 @@ def server():
                 queue_inventory.return_item(q)
 
         def audio_streaming(self, sample_bytes=None):
-            q = stream_queue_inventory.checkout_item()
+            # a slow client loses samples rather than stalling capture
+            q = stream_queue_inventory.checkout_item(drop=True)
             filename = f'{state.frequency:.0f}_{state.rate:.0f}_{timestamp()}'
             filename += '.wav' if sample_bytes else '.cf32'
             content_type = 'audio/wav' if sample_bytes else 'audio/cf32'
@@ -349,14 +610,40 @@ def server():
                         frequency=state.frequency, 
                         rate=state.rate)
                     self.send_chunk(buf)
+                pcm = PCMConverter()
                 while True:
                     d = q.get()
                     if sample_bytes == 2:
-                        d = np.ceil(0x8000 * d).astype(np.int16)
-                    self.send_chunk(d.tobytes())
+                        d = pcm.convert(d)
+                    # send the array's own memory, without a bytes copy
+                    self.send_chunk(memoryview(d).cast('B'))
             except (BrokenPipeError, ConnectionResetError):
                 stream_queue_inventory.return_item(q)
 
+        def file_download(self, filename):
+            try:
+                f = open(filename, 'rb')
+            except OSError:
+                return self.text_response('Not Found', code=404)
+            content_type = 'audio/cf32' if state.cf32 else 'audio/wav'
+            basename = os.path.basename(filename)
+            try:
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    self.send_response(200)
+                    self.send_header('Content-Disposition', f'attachment; filename="{basename}"')
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', size)
+                    self.end_headers()
+                    # let the kernel copy the file to the socket
+                    self.wfile.flush()
+                    sent = self.request.sendfile(f, 0, size)
+                    if sent < size:
+                        # the file was truncated under us
+                        self.close_connection = True
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
         def text_response(self, data=None, code=200, success=True):
             if not success:
                 text = 'Bad Request'
@@ -434,10 +721,8 @@ def server():
                data = get_radio_setting(state.radio, path[1])
             ###
             elif self.path == '/setting':
-               data = ''
-               for d in state.radio.getSettingInfo():
-                   value = state.radio.readSetting(d.key)
-                   data += '{}: "{}"\n'.format(d.key, value)
+               data = ''.join('{}: "{}"\n'.format(key, state.radio.readSetting(key))
+                              for key in state.setting_keys)
             elif self.path == '/bins':
                data = state.bins
             elif self.path == '/rbw':
@@ -459,6 +744,8 @@ def server():
                return self.audio_streaming(sample_bytes=4)
             elif self.path == '/cf32':
                return self.audio_streaming()
+            elif self.path == '/download' and state.recording:
+               return self.file_download(state.recording)
             else:
                return self.text_response('Not Found', code=404)
             self.text_response(data)
@@ -483,7 +770,9 @@ def server():
 def meter_power():
     stream = stream_queue_inventory.checkout_item()
     resolution = np.finfo(np.float16).resolution
-    scale = ".:-=+*#%@"
+    inv_resolution = np.float32(1 / resolution)
+    db_scale = np.float32(20 / np.log2(10)) # 20 * log10(x) == db_scale * log2(x)
+    scale = np.frombuffer(b".:-=+*#%@", dtype=np.uint8)
 
     fft_n = state.rate / state.rbw if state.rbw else state.bins
     fft_n = int(2**np.ceil(np.log(fft_n) / np.log(2)))
@@ -493,13 +782,16 @@ def meter_power():
     fft_start = fft_freq[0]
     fft_stop = fft_freq[-1]
     fft_step = fft_freq[1] - fft_freq[0]
-    window = np.hanning(fft_n)
-    data = np.zeros(2 * fft_n, dtype=np.float32)
+    # the 1/fft_n normalization is folded into the window
+    window = (np.hanning(fft_n) / fft_n).astype(np.float32)
+    frame_size = 2 * fft_n # floats of interleaved IQ per fft
+    dbm_format = ','.join(['%.1f'] * fft_n)
 
     average = (state.average if state.average else 
                int(np.ceil(state.integration / fft_time)))
     total_samples = average * fft_n
-    power = np.zeros((average, fft_n), dtype=np.float32)
+    inv_average = np.float32(1 / average)
+    power = np.zeros(fft_n, dtype=np.float32) # running sum of magnitudes
 
     state.bins = fft_n
     state.rbw = state.rate / fft_n
@@ -510,49 +802,92 @@ def meter_power():
     print(f'average = {state.average}')
     print(f'rbw = {state.rbw:.2f} Hz')
 
+    def publish(ps):
+        # 20 * log10((ps + resolution) / resolution), in place
+        ps *= inv_resolution
+        ps += 1
+        np.log2(ps, out=ps)
+        ps *= db_scale
+
+        current = waterfall_queue_inventory.current()
+        if state.waterfall or current:
+            level = ps - ps.min()
+            index = (len(scale) * level / (level.max() + 1e-3)).astype(np.intp)
+            waterfall = scale[index].tobytes().decode()
+            text = f'{waterfall} {state.dbfs:.2f}'
+            if state.waterfall:
+                console.println(text)
+            for q in current:
+                q.put(text)
+
+        current = power_queue_inventory.current()
+        if current:
+            now = datetime.datetime.now(datetime.UTC)
+            ds = now.strftime('%Y-%m-%d')
+            ts = now.strftime('%H:%M:%S')
+            dbm = dbm_format % tuple(ps.tolist())
+            text = f'{ds},{ts},{fft_start:.0f},{fft_stop:.0f},{fft_step:.0f},{total_samples},{dbm}'
+            for q in current:
+                q.put(text)
+
+    frames = None
     row = 0
     col = 0
     while True:
         d = stream.get()
+        if not (state.waterfall or waterfall_queue_inventory.active() or
+                power_queue_inventory.active()):
+            # nobody is watching, start a fresh average once somebody is
+            if row or col:
+                row = col = 0
+                power.fill(0)
+            continue
+        if frames is None:
+            # room for a whole packet on top of a partial frame
+            batch = stream_buffer_pool.size // frame_size + 2
+            frames = np.zeros((batch, fft_n), dtype=np.complex64)
+            frames_view = frames.view(np.float32).reshape(-1)
+            windowed = np.empty((batch, fft_n), dtype=np.complex64)
+            magnitude = np.empty((batch, fft_n), dtype=np.float32)
         i = 0
         n = len(d)
         while i < n:
-            size = min(n - i, 2 * fft_n - col)
-            data[col:col+size] = d[i:i+size]
-            i += size
-            col += size
-            if col < 2 * fft_n:
-                break
-            ps = data[::2] + data[1::2] * 1j
-            ps = abs(np.fft.fft(ps * window)) / fft_n
-            power[row,:] = np.fft.fftshift(ps)
-            col = 0
-            row += 1
-            if row == average:
-               row = 0 
-               ps = np.average(power, axis=0)
-               ps = 20 * np.log10((ps + resolution) / resolution)
-
-               current = waterfall_queue_inventory.current()
-               if state.waterfall or current:
-                   ps -= min(ps)
-                   values = len(scale) * ps / (max(ps) + 1e-3)
-                   waterfall = ''.join([ scale[i] for i in values.astype(np.int32) ])
-                   text = f'{waterfall} {state.dbfs:.2f}'
-                   if state.waterfall:
-                       print(text)
-                   for q in current:
-                       q.put(text)
-
-               current = power_queue_inventory.current()
-               if current:
-                   now = datetime.datetime.now(datetime.UTC)
-                   ds = now.strftime('%Y-%m-%d')
-                   ts = now.strftime('%H:%M:%S')
-                   dbm = ','.join(f'{d:.1f}' for d in ps)
-                   text = f'{ds},{ts},{fft_start:.0f},{fft_stop:.0f},{fft_step:.0f},{total_samples},{dbm}'
-                   for q in current:
-                       q.put(text)
+            if col == 0 and n - i >= frame_size:
+                # window whole frames straight out of the packet
+                count = (n - i) // frame_size
+                block = d[i:i+count*frame_size]
+                i += count * frame_size
+                rest = 0
+            else:
+                size = min(n - i, frames_view.size - col)
+                frames_view[col:col+size] = d[i:i+size]
+                i += size
+                col += size
+                count = col // frame_size
+                if not count:
+                    break
+                block = frames_view[:count*frame_size]
+                rest = col - count * frame_size
+
+            # fft every complete frame in one call
+            block = block.view(np.complex64).reshape(count, fft_n)
+            ps = np.multiply(block, window, out=windowed[:count])
+            frames_view[:rest] = frames_view[col-rest:col]
+            col = rest
+            ps = np.fft.fft(ps, axis=1)
+            ps = np.abs(ps, out=magnitude[:count])
+
+            j = 0
+            while j < count:
+                size = min(count - j, average - row)
+                power += ps[j:j+size].sum(axis=0)
+                j += size
+                row += size
+                if row == average:
+                    row = 0
+                    # shift only the averaged spectrum, not every frame
+                    publish(np.fft.fftshift(power * inv_average))
+                    power.fill(0)
 
 
 #########################
@@ -560,33 +895,55 @@ def meter_power():
 #########################
 
 def meter_set_peak(x):
-    state.dbfs = np.round(20 * np.log10(x + state.resolution), 1)
+    # a scalar, so math is much cheaper than a numpy ufunc call
+    state.dbfs = round(20 * math.log10(x + state.resolution), 1)
 
     
-def meter_peak():
-    state.resolution = np.finfo(np.float32).resolution
-    meter_set_peak(0)
-    stream = stream_queue_inventory.checkout_item()
-    peak = 0
-    count = 0
-    while True:
-        d = stream.get()
-        peak = max(peak, abs(d).max())
-        count += d.size
-        if count > 2 * state.refresh * state.rate:
-            meter_set_peak(peak)
+class PeakMeter:
+    # runs on the capture thread, so it costs one reduction per packet
+    # rather than a queue and a thread of its own
+    def __init__(self):
+        self.magnitude = None
+        self.peak = 0
+        self.count = 0
+
+    def initialize(self):
+        state.resolution = np.finfo(np.float32).resolution
+        meter_set_peak(0)
+
+    def update(self, d):
+        if not (state.meter or state.waterfall or 
+                peak_queue_inventory.active() or 
+                waterfall_queue_inventory.active()):
+            self.peak = 0
+            self.count = 0
+            return
+        # peak of the IQ magnitude, not of the separate I and Q values
+        iq = d.view(np.complex64)
+        if self.magnitude is None or self.magnitude.shape != iq.shape:
+            self.magnitude = np.empty(iq.shape, dtype=np.float32)
+        self.peak = max(self.peak, np.abs(iq, out=self.magnitude).max())
+        self.count += d.size
+        if self.count > 2 * state.refresh * state.rate:
+            meter_set_peak(self.peak)
             if state.meter and not state.waterfall:
-                println(state.dbfs)
+                console.println(state.dbfs)
             for q in peak_queue_inventory.current():
                 q.put(state.dbfs)
-            peak = 0
-            count = 0
+            self.peak = 0
+            self.count = 0
+
+
+peak_meter = PeakMeter()
 
 
 #########################
 # writer
 #########################
 
+WRITE_BUFFER_SIZE = 2**20 # coalesce packets into fewer write syscalls
+WRITE_FLUSH_INTERVAL = 0.1 # but never hold samples longer than this (sec)
+
 def writer_record(q):
     # get filename
     basename, ext = os.path.splitext(state.output)
@@ -595,9 +952,12 @@ def writer_record(q):
     default_ext = '.cf32' if state.cf32 else '.wav'
     filename = '{}{}'.format(basename, ext or default_ext)
 
-    # open wav file
+    # open wav file, which is no longer downloadable if it is being
+    # overwritten
+    if state.recording == filename:
+        state.recording = None
     println('Writing IQ stream to file: "{}".'.format(filename))
-    fd = open(filename, "wb+")
+    fd = open(filename, "wb+", buffering=WRITE_BUFFER_SIZE)
 
     if not state.cf32:
         param = {
@@ -606,22 +966,32 @@ def writer_record(q):
             'rate': state.rate, 
             'rf64': state.rf64
         }
-        wav_buf = wav_header(**param)
+        wav_buf = bytearray(wav_header(**param))
         fd.write(wav_buf)
 
     # begin recording
     try:
         data_size = 0
+        pcm = PCMConverter()
+        flush_time = time.monotonic() + WRITE_FLUSH_INTERVAL
         while not state.quit and not state.pause:
             d = q.get()
             if state.sample_bytes == 2:
-                d = np.ceil(0x8000 * d).astype(np.int16)
+                d = pcm.convert(d)
             fd.write(d)
             data_size += d.nbytes
+            now = time.monotonic()
+            if now >= flush_time:
+                fd.flush()
+                flush_time = now + WRITE_FLUSH_INTERVAL
         if not state.cf32:
+            # patch the sizes into the header already written, so the
+            # start time is kept, and rewrite it in place
+            wav_set_size(wav_buf, state.sample_bytes, state.rf64, data_size)
             fd.seek(0)
-            fd.write(wav_header(data_size=data_size, **param))
+            fd.write(wav_buf)
         fd.close()
+        state.recording = filename
         println('IQ file closed.')
     except OSError as e:
         state.quit = True
@@ -686,10 +1056,14 @@ def capture(radio):
     show_radio_setting(radio, 'direct_samp')
 
     # setup
-    data = np.array([0] * 2 * args.packet_size, np.float32)
-    maxsize = int(np.ceil(args.buffer_size * 2**20 / data.nbytes))
+    stream_buffer_pool.initialize(2 * args.packet_size, count=16)
+    packet_bytes = 2 * args.packet_size * np.dtype(np.float32).itemsize
+    maxsize = int(np.ceil(args.buffer_size * 2**20 / packet_bytes))
     stream_queue_inventory.initialize(maxsize)
     
+    # start console thread
+    console.initialize()
+
     # start writer thread
     t = Thread(target=writer, daemon=True)
     t.start()
@@ -699,26 +1073,35 @@ def capture(radio):
         t = Thread(target=meter_power, daemon=True)
         t.start()
 
-    # start peak meter thread
-    t = Thread(target=meter_peak, daemon=True)
-    t.start()
+    # peak meter runs inline on the capture loop
+    peak_meter.initialize()
 
     # start webserver thread
     t = Thread(target=server, daemon=True)
     t.start()
 
     # start stream
-    stream = radio.setupStream(SOAPY_SDR_RX, SOAPY_SDR_CF32)
+    stream_args = {}
+    if args.stream_buffers:
+        stream_args['buffers'] = str(args.stream_buffers)
+    stream = radio.setupStream(SOAPY_SDR_RX, SOAPY_SDR_CF32, [DEVICE_CHANNEL], stream_args)
     radio.activateStream(stream) 
     while not state.done:
         try:
+            data = stream_buffer_pool.acquire()
             sr = radio.readStream(stream, [data], args.packet_size)
             if sr.ret < 0:
                 print('failed to read stream, did sdr disconnect?')
                 break
-            d = data.copy()
-            for q in stream_queue_inventory.current():
-                q.put(d)
+            if not sr.ret:
+                stream_buffer_pool.share(data, 0)
+                continue
+            # only fan out the samples actually read
+            current = stream_queue_inventory.current()
+            data = stream_buffer_pool.share(data, len(current), 2 * sr.ret)
+            for q in current:
+                q.put(data)
+            peak_meter.update(data)
         except SystemError as e:
             println(f'\nSystem error "{e}", quitting.')
             break
@@ -726,6 +1109,7 @@ def capture(radio):
             println('\nCapture interrupted, quitting.')
             break
     state.quit = True
+    console.flush()
 
 
 #########################